@@ -0,0 +1,78 @@
+-- Brings a database built from an earlier databaseSchema.sql up to date in place.
+-- databaseSchema.sql drops every table, this file only adds what is missing and is
+-- safe to run more than once.
+
+-- camp_dpmt upper case department name used for exact match lookups
+ALTER TABLE IF EXISTS public.camp_dpmt
+	ADD COLUMN IF NOT EXISTS dpmt_name_upper varchar(50) GENERATED ALWAYS AS (upper(dpmt_name)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_camp_dpmt_name_upper
+	ON public.camp_dpmt(dpmt_name_upper);
+
+-- ============================================================
+-- INSERT-BADGE-REQUIREMENTS insert_badge_requirements FUNCTION
+-- ============================================================
+
+-- Earlier versions took the parent id used for recursion as a third parameter
+DROP FUNCTION IF EXISTS public.insert_badge_requirements(uuid, jsonb, uuid);
+
+-- Inserts a whole requirement tree for a badge in one call. tree is a jsonb array of
+-- {rqmt_idnf, rqmt_desc, requirements} objects, nested requirements are inserted
+-- under the rqmt_id of their parent. The call is atomic, so a badge that already has
+-- requirements was fully loaded before and is left as is, making a repeated call a no-op.
+-- The tree is walked with a work queue rather than recursion so the only signature
+-- PostgREST exposes is (badge_id, tree).
+CREATE OR REPLACE FUNCTION public.insert_badge_requirements(badge_id uuid, tree jsonb)
+RETURNS void AS $$
+DECLARE
+	rqmt_queue jsonb[] := ARRAY[]::jsonb[];
+	parent_queue uuid[] := ARRAY[]::uuid[];
+	child jsonb;
+	new_rqmt_id uuid;
+	i integer := 1;
+BEGIN
+	-- Serialize calls for the same badge so a concurrent one sees the other's rows once it commits
+	PERFORM pg_advisory_xact_lock(hashtextextended(insert_badge_requirements.badge_id::text, 0));
+
+	IF EXISTS (
+		SELECT 1 FROM public.merit_badge_rqmt
+		WHERE merit_badge_rqmt.badge_id = insert_badge_requirements.badge_id
+	) THEN
+		RETURN;
+	END IF;
+
+	FOR child IN
+		SELECT elements.value
+		FROM jsonb_array_elements(COALESCE(tree, '[]'::jsonb)) WITH ORDINALITY AS elements(value, idx)
+		ORDER BY elements.idx
+	LOOP
+		rqmt_queue := array_append(rqmt_queue, child);
+		parent_queue := array_append(parent_queue, NULL::uuid);
+	END LOOP;
+
+	-- Parents are always queued, and so inserted, before their children
+	WHILE i <= COALESCE(array_length(rqmt_queue, 1), 0) LOOP
+		INSERT INTO public.merit_badge_rqmt (badge_id, rqmt_desc, rqmt_idnf, parent_rqmt_id)
+		VALUES (
+			insert_badge_requirements.badge_id,
+			rqmt_queue[i]->>'rqmt_desc',
+			rqmt_queue[i]->>'rqmt_idnf',
+			parent_queue[i]
+		)
+		RETURNING merit_badge_rqmt.rqmt_id INTO new_rqmt_id;
+
+		IF jsonb_typeof(rqmt_queue[i]->'requirements') = 'array' THEN
+			FOR child IN
+				SELECT elements.value
+				FROM jsonb_array_elements(rqmt_queue[i]->'requirements') WITH ORDINALITY AS elements(value, idx)
+				ORDER BY elements.idx
+			LOOP
+				rqmt_queue := array_append(rqmt_queue, child);
+				parent_queue := array_append(parent_queue, new_rqmt_id);
+			END LOOP;
+		END IF;
+
+		i := i + 1;
+	END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,6 +1,12 @@
+import sys
+from operator import itemgetter
 from typing import List
 from enum import Enum
 
+# Fetch all of the required json properties in one call, a missing one raises KeyError
+_RQ_FIELDS = itemgetter('rqmt_idnf', 'rqmt_desc')
+_MB_FIELDS = itemgetter('badge_name', 'badge_desc', 'eagle_badge', 'dpmt_name', 'requirements')
+
 class TroopType(Enum):
     BTROOP = "BTROOP"
     GTROOP = "GTROOP"
@@ -10,6 +16,8 @@ class TroopType(Enum):
 
 class Requirement(object):
 
+    __slots__ = ("rqmt_idnf", "rqmt_desc", "requirements", "parent_rqmt_id", "badge_id", "rqmt_id")
+
     def __init__(self, rqmt_idnf: str, rqmt_desc: str, requirements: List['Requirement']):
         self.rqmt_idnf = rqmt_idnf
         self.rqmt_desc = rqmt_desc
@@ -21,50 +29,88 @@ class Requirement(object):
 
     @classmethod
     def convert_requirement_from_json(cls, dictionary: dict):
-        # Make sure required properties are in description
-        if 'rqmt_idnf' in dictionary and 'rqmt_desc' in dictionary:
-            #Check for nested requirements
-            if 'requirements' in dictionary and dictionary['requirements'] is not None:
-                # Recursively convert nested requirements
-                requirements = [
-                    cls.convert_requirement_from_json(req) for req in dictionary.get('requirements', [])
-                ]
-            else:
-                requirements = []
-
-            return cls(
-                rqmt_idnf=dictionary['rqmt_idnf'],
-                rqmt_desc=dictionary['rqmt_desc'],
-                requirements=requirements
+        # Build the tree with an explicit stack rather than recursing once per requirement
+        converted = []
+        stack = [(converted, dictionary)]
+        while stack:
+            siblings, requirement_dict = stack.pop()
+            # Make sure required properties are in description
+            try:
+                rqmt_idnf, rqmt_desc = _RQ_FIELDS(requirement_dict)
+            except KeyError:
+                siblings.append(None)
+                continue
+
+            requirement = cls(
+                rqmt_idnf=rqmt_idnf,
+                rqmt_desc=rqmt_desc,
+                requirements=[]
             )
-        return None
+            siblings.append(requirement)
+
+            #Check for nested requirements, pushed in reverse so they are appended in order
+            if 'requirements' in requirement_dict and requirement_dict['requirements'] is not None:
+                stack.extend((requirement.requirements, req) for req in reversed(requirement_dict['requirements']))
+
+        return converted[0]
+
+    @classmethod
+    def convert_requirements_to_json(cls, requirements: List['Requirement']) -> list:
+        # Inverse of convert_requirement_from_json, walked with an explicit stack as well
+        converted = []
+        stack = [(converted, requirement) for requirement in reversed(requirements)]
+        while stack:
+            siblings, requirement = stack.pop()
+            # Malformed entries come out of convert_requirement_from_json as None, leave them out
+            if requirement is None:
+                print("Skipping malformed requirement missing rqmt_idnf or rqmt_desc", file=sys.stderr)
+                continue
+
+            requirement_dict = {
+                'rqmt_idnf': requirement.rqmt_idnf,
+                'rqmt_desc': requirement.rqmt_desc,
+                'requirements': []
+            }
+            siblings.append(requirement_dict)
+
+            if requirement.requirements is not None:
+                stack.extend((requirement_dict['requirements'], req) for req in reversed(requirement.requirements))
+
+        return converted
 
 
 class MeritBadge(object):
 
+    __slots__ = ("badge_id", "badge_name", "badge_desc", "eagle_badge", "dpmt_name", "dpmt_name_upper", "requirements")
+
     def __init__(self, badge_name: str, badge_desc: str, eagle_badge: bool, dpmt_name: str, requirements: List[Requirement]):
         self.badge_id = None
         self.badge_name = badge_name
         self.badge_desc = badge_desc
         self.eagle_badge = eagle_badge
         self.dpmt_name = dpmt_name
+        # Department names are grouped and looked up upper case, so do it once and intern the key
+        self.dpmt_name_upper = sys.intern(dpmt_name.upper())
         self.requirements = requirements
 
     @classmethod
     def convert_merit_badge_from_json(cls, dictionary: dict):
 
         #Convert json dictionary to merit badge object
-        if 'badge_name' in dictionary and 'badge_desc' in dictionary and 'eagle_badge' in dictionary and 'dpmt_name' in dictionary and 'requirements' in dictionary:
-            # Convert the requirements
-            requirements = [Requirement.convert_requirement_from_json(req) for req in dictionary.get('requirements', [])]
-            return cls(
-                badge_name=dictionary['badge_name'],
-                badge_desc=dictionary['badge_desc'],
-                eagle_badge=dictionary['eagle_badge'],
-                dpmt_name=dictionary['dpmt_name'],
-                requirements=requirements
-            )
-        return None
+        try:
+            badge_name, badge_desc, eagle_badge, dpmt_name, requirements = _MB_FIELDS(dictionary)
+        except KeyError:
+            return None
+
+        # Convert the requirements
+        requirements = [Requirement.convert_requirement_from_json(req) for req in requirements]
+        return cls(
+            badge_name=badge_name,
+            badge_desc=badge_desc,
+            eagle_badge=eagle_badge,
+            dpmt_name=dpmt_name,
+            requirements=requirements
+        )
 
 
 class Scout(object):
@@ -1,10 +1,21 @@
-import json as js
+try:
+    import orjson as js
+except ImportError:
+    import json as js
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
 import os
 import sys
 
+import httpx
 import supabase as sb
 from dotenv import load_dotenv
 import glob
+from concurrent.futures import ThreadPoolExecutor
+
+from supabase_helpers import HTTPX_LIMITS, HTTPX_TIMEOUT, retry_transient
 
 from postgrest import APIError
 
@@ -14,8 +25,15 @@ load_dotenv()
 SUPABASE_URL = os.environ.get("EXPO_PUBLIC_SUPABASE_URL", "YOUR_SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("EXPO_PUBLIC_SUPABASE_ANON_KEY", "YOUR_SUPABASE_ANON_KEY")
 
+# Direct Postgres connection string, when set the departments are bulk loaded with COPY instead of PostgREST
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
+
 
-supabase: sb.Client = sb.create_client(SUPABASE_URL, SUPABASE_KEY)
+
+# One pooled keep-alive client so every request reuses the same connections
+supabase: sb.Client = sb.create_client(SUPABASE_URL, SUPABASE_KEY, options=sb.ClientOptions(
+    httpx_client=httpx.Client(limits=HTTPX_LIMITS, timeout=HTTPX_TIMEOUT, follow_redirects=True, http2=True)
+))
 
 if supabase:
     print("Connected to Supabase!")
@@ -24,20 +42,61 @@ else:
 
 department_files = [file for file in glob.glob("./departments/*.json")]
 
-departments = []
+def load_department_file(file: str):
+    with open(file, "rb") as open_file:
+        return js.loads(open_file.read())
 
-for file in department_files:
-    with open(file, "r") as open_file:
-        data = js.load(open_file)
+departments = []
 
+# Read and parse the department files in parallel, keeping them in file order
+with ThreadPoolExecutor(max_workers=8) as executor:
+    for data in executor.map(load_department_file, department_files):
         departments.extend(data)
 
-for department in departments:
-    try:
-        new_department = {"dpmt_name": department['dpmt_name']}
-        print(supabase.table("camp_dpmt").insert(new_department).execute().data)
-    except APIError as api:
-        print(f"API ERROR DETECTED: {api.message}", file=sys.stderr)
-    except Exception as e:
-        print(f"GENERAL ERROR DETECTED: {e}", file=sys.stderr)
+def copy_departments(departments: [dict], db_url: str):
+    dpmt_names = [department['dpmt_name'] for department in departments]
+
+    with psycopg.connect(db_url) as conn:
+        with conn.cursor() as cur:
+            with cur.copy("COPY public.camp_dpmt (dpmt_name) FROM STDIN") as copy:
+                for dpmt_name in dpmt_names:
+                    copy.write_row((dpmt_name,))
+
+            # COPY cannot return the generated ids so fetch them all in one query
+            cur.execute("SELECT dpmt_name, dpmt_id FROM public.camp_dpmt WHERE dpmt_name = ANY(%s)", (dpmt_names,))
+            dpmt_ids = {dpmt_name: str(dpmt_id) for dpmt_name, dpmt_id in cur.fetchall()}
+
+    for department in departments:
+        department["dpmt_id"] = dpmt_ids.get(department['dpmt_name'])
+    print(dpmt_ids)
+
+
+# Transient failures are retried with backoff, the error is only reported once the attempts run out
+@retry_transient
+def bulk_upsert(table: str, rows: [dict], on_conflict: str):
+    return supabase.table(table).upsert(rows, on_conflict=on_conflict).execute().data
+
+
+def insert_departments(departments: [dict]):
+    # Upsert every department in a single request instead of one round trip per row,
+    # a retried or re-run request hands back the existing ids instead of failing on dpmt_name
+    new_departments = [{"dpmt_name": department['dpmt_name']} for department in departments]
+
+    data = bulk_upsert("camp_dpmt", new_departments, "dpmt_name")
+
+    if data is not None:
+        dpmt_ids = {row["dpmt_name"]: row["dpmt_id"] for row in data}
+        for department in departments:
+            department["dpmt_id"] = dpmt_ids.get(department['dpmt_name'])
+        print(data)
+
 
+try:
+    if SUPABASE_DB_URL and psycopg is not None:
+        copy_departments(departments, SUPABASE_DB_URL)
+    else:
+        insert_departments(departments)
+except APIError as api:
+    print(f"API ERROR DETECTED: {api.message}", file=sys.stderr)
+except Exception as e:
+    print(f"GENERAL ERROR DETECTED: {e}", file=sys.stderr)
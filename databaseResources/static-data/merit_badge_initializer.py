@@ -1,75 +1,221 @@
-import json as js
+try:
+    import orjson as js
+except ImportError:
+    import json as js
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+import asyncio
+import codecs
 import os
 import sys
+import uuid
 from warnings import catch_warnings
 
+import httpx
 import supabase as sb
 from dotenv import load_dotenv
-import glob
+from concurrent.futures import ThreadPoolExecutor
 
-from supabase import Client
+from supabase import AsyncClient
 
 from database_objects import MeritBadge, Requirement
+from supabase_helpers import HTTPX_LIMITS, HTTPX_TIMEOUT, post_rpc, retry_transient
 
 from postgrest import APIError
 
-count = 0
+# Files larger than this are streamed with ijson instead of being parsed in one go
+LARGE_FILE_SIZE = 10 * 1024 * 1024
 
-def print_all_requirements(requirements: [Requirement], indent: str):
-    for requirement in requirements:
-        print(f"{indent}RQMT_IDNF: {requirement.rqmt_idnf}\n{indent}RQMT_DESC: {requirement.rqmt_desc}")
-        global count
+# Upper bound on Supabase requests in flight at once during the upload
+MAX_CONCURRENT_REQUESTS = 8
+
+def count_and_format_requirements(requirements: [Requirement], indent: str, lines: [str] = None) -> int:
+    # Depth first walk with an explicit stack, children pushed in reverse to keep their order.
+    # Lines are only built when a list is passed in, the count is always returned
+    count = 0
+    stack = [(requirement, indent) for requirement in reversed(requirements)]
+    while stack:
+        requirement, requirement_indent = stack.pop()
         count += 1
+        if lines is not None:
+            lines.append(f"{requirement_indent}RQMT_IDNF: {requirement.rqmt_idnf}")
+            lines.append(f"{requirement_indent}RQMT_DESC: {requirement.rqmt_desc}")
         if(requirement.requirements is not None and len(requirement.requirements) > 0):
-            print_all_requirements(requirement.requirements, f"{indent}\t")
+            stack.extend((child, f"{requirement_indent}\t") for child in reversed(requirement.requirements))
+    return count
+
+
+def stream_merit_badges(file: str) -> [MeritBadge]:
+    # A large file holding an array of badges converts each one as soon as it is parsed
+    # so the whole document never has to be held in memory. Returns None for any other
+    # top level value so the caller can parse it normally
+    with open(file, "rb") as open_file:
+        # ijson rejects a UTF-8 byte order mark, so step over one if present
+        if open_file.read(3) != codecs.BOM_UTF8:
+            open_file.seek(0)
+        start = open_file.tell()
+
+        first_event = next(ijson.parse(open_file), None)
+        if first_event is None or first_event[1] != "start_array":
+            return None
+
+        open_file.seek(start)
+        return [MeritBadge.convert_merit_badge_from_json(badge)
+                for badge in ijson.items(open_file, "item", use_float=True)]
+
+
+def load_merit_badge_file(department_file: (str, str)):
+    department, file = department_file
+    try:
+        if ijson is not None and os.path.getsize(file) > LARGE_FILE_SIZE:
+            merit_badges = stream_merit_badges(file)
+            if merit_badges is not None:
+                return department, merit_badges
+
+        with open(file, "rb") as open_file:
+            data = js.loads(open_file.read())
+            if isinstance(data, list):
+                return department, [MeritBadge.convert_merit_badge_from_json(badge) for badge in data]
+            return department, [MeritBadge.convert_merit_badge_from_json(data)]
+    except Exception as e:
+        print(f"Directory: {department}, File: {file}, Exception: {e}", file=sys.stderr)
+        raise e
+
+
+# The semaphore is released while waiting between retry attempts
+@retry_transient
+async def execute_limited(query, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        return await query.execute()
 
 
-def add_merit_badges_by_dpmt(departments_with_merit_badges: dict[str, [MeritBadge]], sb: Client):
-    for department in departments_with_merit_badges.keys():
-        dpmt_id = (sb.table("camp_dpmt")
-                    .select("dpmt_id")
-                    .ilike("dpmt_name", department)
-                    .maybe_single()
-                    .execute().data["dpmt_id"])
+@retry_transient
+async def insert_badge_requirements(sb: AsyncClient, merit_badge: MeritBadge, semaphore: asyncio.Semaphore):
+    # The requirement trees are the bulk of the upload, so the payload is serialized once here
+    # and posted directly rather than being re-encoded by the query builder
+    payload = js.dumps({
+        "badge_id": merit_badge.badge_id,
+        "tree": Requirement.convert_requirements_to_json(merit_badge.requirements)
+    })
+    async with semaphore:
+        await post_rpc(sb, "insert_badge_requirements", payload)
 
-        print(f"Department Name: {department}\nDepartment ID: {dpmt_id}\n")
 
-        for merit_badge in departments_with_merit_badges[department]:
-            try:
-                new_merit_badge = {"badge_name": merit_badge.badge_name, "badge_desc": merit_badge.badge_desc, "eagle_badge": merit_badge.eagle_badge, "dpmt_id": dpmt_id}
-                data = supabase.table("merit_badge").insert(new_merit_badge).execute().data
+async def bulk_upsert(sb: AsyncClient, table: str, rows: [dict], on_conflict: str, semaphore: asyncio.Semaphore):
+    return (await execute_limited(sb.table(table).upsert(rows, on_conflict=on_conflict), semaphore)).data
 
-                if data is not None:
-                    merit_badge_id = data[0]["badge_id"]
-                    merit_badge.badge_id = merit_badge_id
 
-                    insert_merit_badge_requirements_recursively(merit_badge_id, merit_badge.requirements, None)
+async def add_merit_badges_by_dpmt(departments_with_merit_badges: dict[str, [MeritBadge]], sb: AsyncClient):
+    # Look up every department id in one query rather than one per department
+    # Keys are already upper case, matched against the generated column so the lookup is an indexed exact match
+    dpmt_names = list(departments_with_merit_badges.keys())
+    dpmt_data = (await sb.table("camp_dpmt")
+                 .select("dpmt_id, dpmt_name_upper")
+                 .in_("dpmt_name_upper", dpmt_names)
+                 .execute()).data
+    dpmt_ids = {dpmt["dpmt_name_upper"]: dpmt["dpmt_id"] for dpmt in dpmt_data}
 
-            except APIError as api:
-                print(f"API ERROR DETECTED: {api.message}", file=sys.stderr)
-            except Exception as e:
-                print(f"GENERAL ERROR DETECTED: {e}", file=sys.stderr)
+    # Departments are independent of each other so their uploads are overlapped
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    await asyncio.gather(*(add_merit_badges_for_dpmt(department, dpmt_ids, merit_badges, sb, semaphore)
+                           for department, merit_badges in departments_with_merit_badges.items()))
 
-def insert_merit_badge_requirements_recursively(badge_id: str, requirements: [Requirement],parent_rqmt_id: str):
 
-    for requirement in requirements:
-        try:
-            requirement.badge_id = badge_id
-            new_requirement = {"badge_id": badge_id, "rqmt_desc": requirement.rqmt_desc,
-                               "rqmt_idnf": requirement.rqmt_idnf}
-            if parent_rqmt_id is not None:
-                new_requirement["parent_rqmt_id"] = parent_rqmt_id
-            data = supabase.table("merit_badge_rqmt").insert(new_requirement).execute().data
-            if data is not None:
-                rqmt_id = data[0]["rqmt_id"]
-                requirement.rqmt_id = rqmt_id
-                if requirement.requirements is not None and len(requirement.requirements) > 0:
-                    insert_merit_badge_requirements_recursively(badge_id, requirement.requirements, rqmt_id)
+async def add_merit_badges_for_dpmt(department: str, dpmt_ids: dict[str, str], merit_badges: [MeritBadge], sb: AsyncClient, semaphore: asyncio.Semaphore):
 
-        except APIError as api:
-            print(f"API ERROR DETECTED: {api.message}", file=sys.stderr)
-        except Exception as e:
-            print(f"GENERAL ERROR DETECTED: {e}", file=sys.stderr)
+    dpmt_id = dpmt_ids.get(department)
+    if dpmt_id is None:
+        print(f"DEPARTMENT NOT FOUND: {department}, skipping {len(merit_badges)} merit badges", file=sys.stderr)
+        return
+
+    print(f"Department Name: {department}\nDepartment ID: {dpmt_id}\n")
+
+    try:
+        # Upsert all of the department's badges in one request, so a retried or re-run
+        # request hands back the existing ids instead of failing on badge_name
+        new_merit_badges = [{"badge_name": merit_badge.badge_name, "badge_desc": merit_badge.badge_desc,
+                             "eagle_badge": merit_badge.eagle_badge, "dpmt_id": dpmt_id}
+                            for merit_badge in merit_badges]
+        data = await bulk_upsert(sb, "merit_badge", new_merit_badges, "badge_name", semaphore)
+
+        if data is not None:
+            badge_ids = {row["badge_name"]: row["badge_id"] for row in data}
+            for merit_badge in merit_badges:
+                merit_badge.badge_id = badge_ids.get(merit_badge.badge_name)
+
+            # Each badge's whole requirement tree goes up in a single call and is
+            # expanded server side by the insert_badge_requirements function
+            # Every upload runs to completion and each failure is reported against its own badge
+            results = await asyncio.gather(*(insert_badge_requirements(sb, merit_badge, semaphore) for merit_badge in merit_badges),
+                                           return_exceptions=True)
+            for merit_badge, result in zip(merit_badges, results):
+                if isinstance(result, APIError):
+                    print(f"API ERROR DETECTED: {merit_badge.badge_name}: {result.message}", file=sys.stderr)
+                elif isinstance(result, Exception):
+                    print(f"GENERAL ERROR DETECTED: {merit_badge.badge_name}: {result}", file=sys.stderr)
+
+    except APIError as api:
+        print(f"API ERROR DETECTED: {api.message}", file=sys.stderr)
+    except Exception as e:
+        print(f"GENERAL ERROR DETECTED: {e}", file=sys.stderr)
+
+
+def copy_merit_badges_by_dpmt(departments_with_merit_badges: dict[str, [MeritBadge]], db_url: str):
+
+    with psycopg.connect(db_url) as conn:
+        with conn.cursor() as cur:
+            dpmt_names = list(departments_with_merit_badges.keys())
+            cur.execute("SELECT dpmt_name_upper, dpmt_id FROM public.camp_dpmt WHERE dpmt_name_upper = ANY(%s)", (dpmt_names,))
+            dpmt_ids = dict(cur.fetchall())
+
+            # Skip departments missing from camp_dpmt like the REST path does, so their requirements are skipped too
+            found_departments = {}
+            for department, merit_badges in departments_with_merit_badges.items():
+                if department in dpmt_ids:
+                    found_departments[department] = merit_badges
+                else:
+                    print(f"DEPARTMENT NOT FOUND: {department}, skipping {len(merit_badges)} merit badges", file=sys.stderr)
+
+            # Ids are generated here so every parent id is known before anything is sent
+            with cur.copy("COPY public.merit_badge (badge_id, badge_name, badge_desc, eagle_badge, dpmt_id) FROM STDIN") as copy:
+                for department, merit_badges in found_departments.items():
+                    for merit_badge in merit_badges:
+                        merit_badge.badge_id = str(uuid.uuid4())
+                        copy.write_row((merit_badge.badge_id, merit_badge.badge_name, merit_badge.badge_desc,
+                                        merit_badge.eagle_badge, dpmt_ids[department]))
+
+            # Parents are written before their children so enforce_same_badge can find them
+            with cur.copy("COPY public.merit_badge_rqmt (rqmt_id, badge_id, rqmt_desc, rqmt_idnf, parent_rqmt_id) FROM STDIN") as copy:
+                for merit_badges in found_departments.values():
+                    for merit_badge in merit_badges:
+                        stack = [(requirement, None) for requirement in reversed(merit_badge.requirements)]
+                        while stack:
+                            requirement, parent_rqmt_id = stack.pop()
+                            if requirement is None:
+                                print(f"Skipping malformed requirement in {merit_badge.badge_name}", file=sys.stderr)
+                                continue
+                            requirement.rqmt_id = str(uuid.uuid4())
+                            requirement.badge_id = merit_badge.badge_id
+                            requirement.parent_rqmt_id = parent_rqmt_id
+                            copy.write_row((requirement.rqmt_id, requirement.badge_id, requirement.rqmt_desc,
+                                            requirement.rqmt_idnf, requirement.parent_rqmt_id))
+                            if requirement.requirements is not None:
+                                stack.extend((child, requirement.rqmt_id) for child in reversed(requirement.requirements))
+
+
+async def upload_merit_badges(departments_with_merit_badges: dict[str, [MeritBadge]]):
+    # One pooled keep-alive client so every request reuses the same connections, closed once the upload is done
+    async with httpx.AsyncClient(limits=HTTPX_LIMITS, timeout=HTTPX_TIMEOUT, follow_redirects=True, http2=True) as httpx_client:
+        async_supabase: AsyncClient = await sb.acreate_client(SUPABASE_URL, SUPABASE_KEY, options=sb.AsyncClientOptions(
+            httpx_client=httpx_client
+        ))
+        await add_merit_badges_by_dpmt(departments_with_merit_badges, async_supabase)
 
 
 
@@ -80,6 +226,11 @@ load_dotenv()
 SUPABASE_URL = os.environ.get("EXPO_PUBLIC_SUPABASE_URL", "YOUR_SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("EXPO_PUBLIC_SUPABASE_ANON_KEY", "YOUR_SUPABASE_ANON_KEY")
 
+# Direct Postgres connection string, when set the badges are bulk loaded with COPY instead of PostgREST
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
+
+VERBOSE = "--verbose" in sys.argv[1:]
+
 
 supabase: sb.Client = sb.create_client(SUPABASE_URL, SUPABASE_KEY)
 
@@ -89,44 +240,50 @@ else:
     print("Failed to connect to Supabase.")
 
 
-department_folders = [folder for folder in glob.glob("./merit-badges/*") if os.path.isdir(folder)]
-
-merit_badge_files = [(os.path.basename(folder.rstrip('/\\')).upper(), file)
-                     for folder in department_folders
-                     for file in glob.glob(os.path.join(folder, "*.json"))]
+# Walk the department folders with scandir so the directory entries supply the type info without extra stat calls
+merit_badge_files = []
 
-# print(department_folders)
+with os.scandir("./merit-badges") as department_folders:
+    for folder in department_folders:
+        # Hidden entries (.git, macOS ._ AppleDouble files, ...) are skipped like glob did
+        if not folder.is_dir() or folder.name.startswith("."):
+            continue
+        department = folder.name.upper()
+        with os.scandir(folder.path) as files:
+            merit_badge_files.extend((department, file.path) for file in files
+                                     if file.is_file() and file.name.endswith(".json") and not file.name.startswith("."))
 
 # print(merit_badge_files)
 
 merit_badges = []
 departments_with_merit_badges_out = {}
 
-for department,file in merit_badge_files:
-    try:
-        with open(file, "r", encoding="utf-8") as open_file:
-            data = js.load(open_file)
-            merit_badge = MeritBadge.convert_merit_badge_from_json(data)
+# Read and parse the badge files in parallel, then group them by department serially
+with ThreadPoolExecutor(max_workers=8) as executor:
+    for department, file_merit_badges in executor.map(load_merit_badge_file, merit_badge_files):
+        for merit_badge in file_merit_badges:
             if merit_badge:
-                departments_with_merit_badges_out.setdefault(merit_badge.dpmt_name.upper(), []).append(merit_badge)
-    except Exception as e:
-        print(f"Directory: {department}, File: {file}, Exception: {e}", file=sys.stderr)
-        raise e
+                departments_with_merit_badges_out.setdefault(merit_badge.dpmt_name_upper, []).append(merit_badge)
 
 
 # print(departments_with_merit_badges_out)
 
-print("hello")
-
+# Dump every badge and its requirements only when asked for, written out in one go
+lines = [] if VERBOSE else None
+total_requirements = 0
 for merit_badge_list in departments_with_merit_badges_out.values():
-    for MeritBadge in merit_badge_list:
-        print(MeritBadge.badge_name)
-        print(MeritBadge.badge_desc)
-        print(MeritBadge.eagle_badge)
-        print(MeritBadge.dpmt_name)
-        print_all_requirements(MeritBadge.requirements, "\t")
+    for mb in merit_badge_list:
+        if lines is not None:
+            lines.extend((mb.badge_name, mb.badge_desc, str(mb.eagle_badge), mb.dpmt_name))
+        total_requirements += count_and_format_requirements(mb.requirements, "\t", lines)
+
+if lines is not None:
+    sys.stdout.write("\n".join(lines) + "\n")
 
-print(f"Total Requirement Count: {count}")
+print(f"Total Requirement Count: {total_requirements}")
 
 
-# add_merit_badges_by_dpmt(departments_with_merit_badges_out, supabase)
\ No newline at end of file
+# if SUPABASE_DB_URL and psycopg is not None:
+#     copy_merit_badges_by_dpmt(departments_with_merit_badges_out, SUPABASE_DB_URL)
+# else:
+#     asyncio.run(upload_merit_badges(departments_with_merit_badges_out))
\ No newline at end of file
@@ -0,0 +1,64 @@
+try:
+    import orjson as js
+except ImportError:
+    import json as js
+
+import httpx
+from postgrest import APIError
+from supabase import AsyncClient
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# Shared by every initializer that injects its own httpx client into Supabase
+
+HTTPX_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+# Match supabase-py's own postgrest client, which an injected httpx client does not inherit
+HTTPX_TIMEOUT = httpx.Timeout(120)
+
+
+# Errors where the request never reached the server, so sending it again cannot double a write
+UNSENT_REQUEST_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+# PostgREST's own 503 codes for when it cannot reach the database or its schema cache is stale
+TRANSIENT_POSTGREST_CODES = frozenset({"PGRST000", "PGRST001", "PGRST002"})
+
+
+def is_transient_error(exception: BaseException) -> bool:
+    if isinstance(exception, UNSENT_REQUEST_ERRORS):
+        return True
+    # postgrest reports a non json error response (a proxy's 502/504, ...) with its HTTP status as the code.
+    # Json errors carry a SQLSTATE or PGRST code and only PostgREST's connection codes are worth retrying,
+    # the rest are permanent (duplicate keys, bad payloads, ...)
+    if isinstance(exception, APIError):
+        code = str(exception.code)
+        return (len(code) == 3 and code.startswith("5")) or code in TRANSIENT_POSTGREST_CODES
+    return False
+
+
+# Transient failures are retried with backoff, wraps both sync and async functions.
+# Only use it on writes that are safe to repeat (upserts, the insert_badge_requirements function)
+retry_transient = retry(wait=wait_exponential(min=0.1, max=4), stop=stop_after_attempt(5),
+                        retry=retry_if_exception(is_transient_error), reraise=True)
+
+
+async def post_rpc(sb: AsyncClient, function_name: str, payload):
+    # Posts an already serialized payload to a database function. An injected httpx client has no
+    # base url or auth headers of its own, so both are taken from the postgrest client
+    url = f"{str(sb.postgrest.base_url).rstrip('/')}/rpc/{function_name}"
+    response = await sb.postgrest.session.post(url, content=payload,
+                                               headers={**sb.postgrest.headers, "Content-Type": "application/json"})
+
+    if response.is_success:
+        return
+
+    # Keep PostgREST's own error so it is retried the same way as the query builder's,
+    # falling back to the HTTP status as the code when the body isn't a json error
+    try:
+        error = js.loads(response.content)
+    except ValueError:
+        error = None
+    if not isinstance(error, dict):
+        error = {"message": response.text, "code": str(response.status_code), "hint": None, "details": None}
+
+    raise APIError(error)
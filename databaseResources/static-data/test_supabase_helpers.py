@@ -0,0 +1,78 @@
+import asyncio
+
+import httpx
+import pytest
+import supabase as sb
+from postgrest import APIError
+
+from supabase_helpers import is_transient_error, post_rpc
+
+SUPABASE_URL = "https://example.supabase.co"
+SUPABASE_KEY = "test-key"
+
+
+def run_post_rpc(handler, payload=b'{"badge_id": "1", "tree": []}'):
+    # Drives post_rpc through a real async client with an injected httpx client, as the initializers build it
+    requests = []
+
+    def record(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return handler(request)
+
+    async def post():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(record)) as httpx_client:
+            client = await sb.acreate_client(SUPABASE_URL, SUPABASE_KEY, options=sb.AsyncClientOptions(
+                httpx_client=httpx_client
+            ))
+            await post_rpc(client, "insert_badge_requirements", payload)
+
+    asyncio.run(post())
+    return requests
+
+
+def test_post_rpc_sends_absolute_url_and_auth_headers():
+    requests = run_post_rpc(lambda request: httpx.Response(204))
+
+    assert len(requests) == 1
+    request = requests[0]
+    assert str(request.url) == f"{SUPABASE_URL}/rest/v1/rpc/insert_badge_requirements"
+    assert request.headers["apikey"] == SUPABASE_KEY
+    assert request.headers["authorization"] == f"Bearer {SUPABASE_KEY}"
+    assert request.headers["content-type"] == "application/json"
+    assert request.content == b'{"badge_id": "1", "tree": []}'
+
+
+def test_post_rpc_keeps_postgrest_error_code():
+    body = {"message": "duplicate key", "code": "23505", "hint": None, "details": None}
+    with pytest.raises(APIError) as error:
+        run_post_rpc(lambda request: httpx.Response(409, json=body))
+
+    assert error.value.code == "23505"
+    assert not is_transient_error(error.value)
+
+
+def test_post_rpc_keeps_transient_postgrest_code():
+    body = {"message": "could not connect", "code": "PGRST001", "hint": None, "details": None}
+    with pytest.raises(APIError) as error:
+        run_post_rpc(lambda request: httpx.Response(503, json=body))
+
+    assert error.value.code == "PGRST001"
+    assert is_transient_error(error.value)
+
+
+def test_post_rpc_falls_back_to_status_for_non_json_body():
+    with pytest.raises(APIError) as error:
+        run_post_rpc(lambda request: httpx.Response(502, text="<html>Bad Gateway</html>"))
+
+    assert error.value.code == "502"
+    assert is_transient_error(error.value)
+
+
+def test_is_transient_error():
+    assert is_transient_error(httpx.ConnectError("refused"))
+    assert is_transient_error(httpx.PoolTimeout("pool"))
+    # The request may already have been sent, so a read timeout is not retried
+    assert not is_transient_error(httpx.ReadTimeout("read"))
+    assert not is_transient_error(APIError({"message": "m", "code": "404"}))
+    assert not is_transient_error(APIError({"message": "m", "code": "PGRST116"}))
+    assert not is_transient_error(ValueError("bad"))